@@ -3,4 +3,10 @@ DTYPE = 'float32'   # Default data type for numerical operations.
 
 USE_GPU = True      # Set to True to use GPU for computations if available
 
+USE_TORCH_COMPILE = False  # Set to True to compile hot tensor functions with torch.compile: the tilting
+                           # exponents θᵀg with the logsumexp (objective) or softmax (tilted statistics)
+                           # applied to them, and matrix-free Hessian-vector products (observables.py). 
+                           # This fuses operations into fewer kernels, but compiling takes some 
+                           # time and is not supported on all backends (e.g., MPS)
+
 assert DTYPE in ['float32', 'float64'], "DTYPE must be either 'float32' or 'float64'"
@@ -4,10 +4,13 @@
 
 import os
 import numpy as np
+import torch
+from numba import njit, prange
 
 import optimizers
 import linear_solvers
-from utils import outer_product, numpy_to_torch, torch_to_numpy
+import observables
+from utils import numpy_to_torch, torch_to_numpy, get_offdiag_mask
 
 
 
@@ -54,14 +57,14 @@ def get_EP_Estimate(data, validation=None, test=None, verbose=0, max_iter=None,
         return 0, x0
     
     if validation is not None and validation.nsamples > 0:
-        val_nsamples = np.log(validation.nsamples) 
+        val_max_objective = validation.max_objective 
     else:
-        val_nsamples = None
+        val_max_objective = None
 
     o = optimizers.optimize(x0=x0, 
             objective=data, validation=validation, max_iter=max_iter, minimize=False, verbose=verbose, 
             optimizer=optimizer, optimizer_kwargs=optimizer_kwargs,
-            max_trn_objective=np.log(data.nsamples), max_val_objective=val_nsamples, **kwargs)
+            max_trn_objective=data.max_objective, max_val_objective=val_max_objective, **kwargs)
     
     if test is not None: # Evaluate the objective on the test set
         ret_objective = test.get_objective(o.x)
@@ -96,14 +99,230 @@ def get_EP_MTUR(data, linsolve_eps=1e-4):
 
     combined_mean  = (data.g_mean + data.rev_g_mean)/2
 
+    if isinstance(data, observables.Dataset) and linsolve_eps > 0 and \
+            data.forward_nsamples + (data.nsamples if data.rev_g_samples is not None else 0) < data.nobservables:
+        # There are fewer samples than observables, so the covariance has low rank. We write it as 
+        # BᵀB - combined_mean combined_meanᵀ, where rows of B are (scaled) samples, and solve the linear
+        # system using the Woodbury identity, without building the covariance matrix
+        if data.rev_g_samples is None:   # antisymmetric observables, so combined_mean is 0
+            B, u = data.g_samples / np.sqrt(data.forward_nsamples), None
+        else:
+            B = torch.vstack([data.g_samples     / np.sqrt(2*data.forward_nsamples), 
+                              data.rev_g_samples / np.sqrt(2*data.nsamples)])
+            u = combined_mean
+        x = linear_solvers.solve_linear_lowrank(B, linsolve_eps, mean_diff, u=u)
+        return float(x @ mean_diff)/2, torch_to_numpy(x)
+
     # Compute covariance of (p + ~p)/2
+    # (using in-place rank-1 updates, which avoid allocating temporary outer product matrices)
     cov, rcov = data.get_covariance(return_forward=True, return_reverse=True)
-    second_moment_forward = cov  + outer_product(data.g_mean, data.g_mean)
-    second_moment_reverse = rcov + outer_product(data.rev_g_mean, data.rev_g_mean)
-    combined_cov = (second_moment_forward + second_moment_reverse)/2 - outer_product(combined_mean, combined_mean)
+    combined_cov = (cov + rcov)/2
+    combined_cov.addr_(data.g_mean, data.g_mean, alpha=0.5)            # second moment of p
+    combined_cov.addr_(data.rev_g_mean, data.rev_g_mean, alpha=0.5)    # second moment of ~p
+    combined_cov.addr_(combined_mean, combined_mean, alpha=-1)
     
-    x  = linear_solvers.solve_linear_psd(combined_cov + linsolve_eps*linear_solvers.eye_like(combined_cov), mean_diff)
+    linear_solvers.add_to_diagonal(combined_cov, linsolve_eps, inplace=True)
+    x  = linear_solvers.solve_linear_psd(combined_cov, mean_diff)
     objective = float(x @ mean_diff)/2
 
     return objective, torch_to_numpy(x)
 
+
+def get_EP_Newton1Step_multipartite(S, F, linsolve_eps=1e-8, num_chunks=None, dtype=None, use_numba=False):
+    # Estimate EP using 1 step of Newton method for all spins of a multipartite system at once.
+    # This gives the same estimates as running get_EP_Newton1Step on the observables returned by
+    # observables.get_g_observables(S, F, i) for each spin i (without holdout data), but the 
+    # statistics of all spins are computed with batched tensor operations and the N linear 
+    # systems are solved with a single batched call, rather than looping over spins.
+    # Note that memory usage scales as N^3, since we keep the covariance matrices of all spins. In
+    # addition, the product over a chunk of samples creates a temporary (chunk size x N x N) tensor.
+    #
+    # Arguments:
+    #   S            : samples_per_spin x N array of states ∈ {-1,1}, as returned by spin_model.run_simulation
+    #   F            : samples_per_spin x N bool array of spin flips, as returned by spin_model.run_simulation
+    #   linsolve_eps (float) : regularization parameter for covariance matrices, used to improve
+    #                          numerical stability of linear solvers
+    #   num_chunks   : number of chunks to use for computing second moments, so that the temporary
+    #                  tensor has about nsamples x N^2 / num_chunks entries. If None, we use chunks of
+    #                  max(N, 2^22 / N^2) samples, which bounds the temporary to max(N^3, 2^22) entries
+    #   dtype        : data type (e.g., 'float32' or torch.bfloat16) used for the matrix products over
+    #                  samples, which dominate the cost. If None, we use the default DTYPE in config.py.
+    #                  The resulting statistics and the linear solves always use DTYPE. Since states 
+    #                  are ±1, the product over a chunk of samples is a sum of integers, which is exact
+    #                  as long as it is representable in dtype (up to 2^24 for float32, 2^11 for float16,
+    #                  2^8 for bfloat16). The chunk size is limited accordingly, and results of each chunk 
+    #                  are accumulated in DTYPE, so low-precision types give the same statistics, e.g., 
+    #                  'float32' when DTYPE='float64'. Note that small chunks add overhead: for bfloat16,
+    #                  1e6 samples require about 4000 separate products of 256 samples, which can cancel
+    #                  the speedup of low-precision arithmetic, while float16 requires 8x fewer products
+    #   use_numba    : if True, we compute on the CPU using numba, processing spins in parallel threads.
+    #                  This avoids torch overhead and the N^3 memory of the batched computation, and 
+    #                  can be faster when no GPU is available (num_chunks and dtype are then ignored).
+    #                  If the covariance of a spin is not positive definite, its results are NaN (the
+    #                  torch version instead falls back to slower solvers, see solve_linear_psd)
+    #
+    # Returns:
+    #   (sigmas, thetas): 1d array (N) of EP estimates of each spin, and 2d array (N x N-1) of 
+    #                     optimal parameters, where row i contains parameters of observables of spin i
+    #   The total EP estimate is sum_i p_i * sigmas[i], where p_i is the frequency of spin i flips
+
+    if use_numba:
+        S = np.ascontiguousarray(torch_to_numpy(S), dtype=np.float64)
+        F = np.ascontiguousarray(torch_to_numpy(F), dtype=np.bool_)
+        sigmas, thetas, ok = _get_EP_Newton1Step_multipartite_numba(S, F, linsolve_eps)
+        if not np.all(ok):
+            # Unlike the torch version, there is no fallback to LU or lstsq in the numba version
+            print(f"Warning: numba Cholesky failed for spins {np.flatnonzero(~ok)}, "
+                  "covariance is not positive definite (try a larger linsolve_eps), returning NaN")
+            sigmas[~ok] = np.nan
+            thetas[~ok] = np.nan
+        return sigmas, thetas
+
+    S = numpy_to_torch(S)
+    F = numpy_to_torch(F)
+    nsamples, N = S.shape
+    nflips = F.sum(axis=0)                  # number of samples in which each spin flipped
+    counts = torch.clamp(nflips, min=1)     # avoid division by 0 for spins that never flipped
+
+    if isinstance(dtype, str):
+        dtype = getattr(torch, dtype)
+    S_prod = S if dtype is None else S.to(dtype)   # copies used for matrix products over samples
+    F_prod = F if dtype is None else F.to(dtype)
+
+    # Second moments <g_ij g_il> = 4 <x_j x_l> of observables g_ij = -2 x_i x_j in the states where 
+    # spin i flipped
+    K = torch.zeros((N, N, N), dtype=S.dtype, device=S.device)
+    if num_chunks is None:
+        chunk_size = max(N, 2**22 // (N*N))
+    else:
+        chunk_size = (nsamples + num_chunks - 1) // num_chunks
+    if dtype is not None:   # largest sum of ±1 terms that is exactly representable in dtype
+        chunk_size = min(chunk_size, int(2 / torch.finfo(dtype).eps))   # 2^(mantissa bits + 1)
+    chunk_size = max(chunk_size, 1)
+    for start in range(0, nsamples, chunk_size):
+        S_chunk = S_prod[start:start+chunk_size]
+        K += torch.einsum('ki,kj,kl->ijl', F_prod[start:start+chunk_size], S_chunk, S_chunk).to(K.dtype)
+    K *= 4 / counts[:, None, None]
+
+    # Means <g_ij>, row i is spin i. Since x_i^2 = 1, these are already contained in the second
+    # moments as <g_ii g_ij> = 4 <x_i x_j> = -2 <g_ij>, so we don't need another product over samples
+    ix     = torch.arange(N, device=S.device)
+    g_mean = K[ix, ix, :].mul_(-0.5)
+    cov    = K.baddbmm_(g_mean[:, :, None], g_mean[:, None, :], alpha=-1)  # in-place batch of rank-1 updates
+
+    # For spin i, the observable g_ii = -2 is constant, so row and column i of the i-th covariance
+    # matrix vanish. Rather than removing them from each system, we set them to the identity and 
+    # zero the corresponding gradient entry, which gives θ_ii = 0 without copying submatrices
+    linear_solvers.add_to_diagonal(cov, linsolve_eps, inplace=True)
+    cov[ix, ix, :]  = 0
+    cov[ix, :, ix]  = 0
+    cov[ix, ix, ix] = 1
+    g_mean.fill_diagonal_(0)
+
+    # Newton step starting from θ=0, where the gradient is 2<g> and the Hessian is -cov
+    theta = linear_solvers.solve_linear_psd(cov, 2 * g_mean)     # shape (N, N), row i is spin i
+
+    # Objective θᵀ<g> - ln <exp(-θᵀg)> for all spins. Because θᵀg = -2 x_i Σ_j θ_ij x_j,
+    # the tilts of all spins can be computed with a single matrix multiplication
+    th_g   = 2 * S * (S @ theta.T)
+    th_g   = th_g.masked_fill(F == 0, -torch.inf)      # only use states where spin i flipped
+    log_Z  = torch.logsumexp(th_g, dim=0) - torch.log(counts)
+    sigmas = torch.where(nflips > 0, (theta * g_mean).sum(axis=1) - log_Z, 0)
+
+    # Drop the diagonal, to follow the ordering of observables in observables.get_g_observables
+    thetas = theta[get_offdiag_mask(N, S.device)].reshape(N, N-1)
+
+    return torch_to_numpy(sigmas), torch_to_numpy(thetas)
+
+
+@njit(parallel=True, fastmath=True)
+def _get_EP_Newton1Step_multipartite_numba(S, F, linsolve_eps):
+    # Numba version of get_EP_Newton1Step_multipartite, parallelized over spins. We use explicit 
+    # loops (including for the Cholesky solve), because numba's linear algebra requires SciPy.
+    # Failures are reported in the boolean array ok, rather than with NaNs, since fastmath lets the
+    # compiler assume that there are no NaNs
+    nsamples, N = S.shape
+    sigmas = np.zeros(N)
+    thetas = np.zeros((N, N-1))
+    ok     = np.ones(N, dtype=np.bool_)
+
+    for i in prange(N):
+        # Second moments of g_ij = -2 x_i x_j in the states where spin i flipped
+        n      = 0
+        K      = np.zeros((N, N))
+        for k in range(nsamples):
+            if F[k, i]:
+                n += 1
+                for j in range(N):
+                    for l in range(j+1):
+                        K[j, l] += 4 * S[k, j] * S[k, l]
+        if n == 0:
+            continue
+
+        # Means, using <g_ii g_ij> = -2 <g_ij> (as in the torch version)
+        g_mean = np.empty(N)
+        for j in range(N):
+            g_mean[j] = -0.5 * (K[j, i] if j >= i else K[i, j])
+
+        # Regularized covariance (lower triangle). As in the torch version, row and column i are 
+        # replaced by the identity and the gradient entry is set to 0, which gives θ_ii = 0
+        g_mean /= n
+        for j in range(N):
+            for l in range(j+1):
+                K[j, l] = K[j, l] / n - g_mean[j] * g_mean[l]
+            K[j, j] += linsolve_eps
+        for j in range(N):
+            K[i, j] = 0.0
+            K[j, i] = 0.0
+        K[i, i]   = 1.0
+        g_mean[i] = 0.0
+
+        # Newton step from θ=0, solving cov θ = 2<g> with Cholesky decomposition cov = L Lᵀ
+        # (overwriting the lower triangle of K with L)
+        failed = False
+        for j in range(N):
+            for l in range(j+1):
+                v = K[j, l]
+                for m in range(l):
+                    v -= K[j, m] * K[l, m]
+                if l == j:
+                    if v <= 0:   # cov is not positive definite
+                        failed  = True
+                        v       = 1.0
+                    K[j, j] = np.sqrt(v)
+                else:
+                    K[j, l] = v / K[l, l]
+        if failed:
+            ok[i] = False
+            continue
+        theta = 2 * g_mean
+        for j in range(N):               # forward substitution
+            for m in range(j):
+                theta[j] -= K[j, m] * theta[m]
+            theta[j] /= K[j, j]
+        for j in range(N-1, -1, -1):     # backward substitution
+            for m in range(j+1, N):
+                theta[j] -= K[m, j] * theta[m]
+            theta[j] /= K[j, j]
+
+        # Objective θᵀ<g> - ln <exp(-θᵀg)>, where -θᵀg = 2 x_i Σ_j θ_ij x_j
+        th_g = np.empty(n)
+        r    = 0
+        for k in range(nsamples):
+            if F[k, i]:
+                v = 0.0
+                for j in range(N):
+                    v += theta[j] * S[k, j]
+                th_g[r] = 2 * S[k, i] * v
+                r += 1
+        th_g_max  = th_g.max()
+        log_Z     = np.log(np.mean(np.exp(th_g - th_g_max))) + th_g_max
+        sigmas[i] = np.sum(theta * g_mean) - log_Z
+
+        r = 0
+        for j in range(N):
+            if j != i:
+                thetas[i, r] = theta[j]
+                r += 1
+
+    return sigmas, thetas, ok
@@ -5,18 +5,34 @@ import warnings
 os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"  # Enable fallback for MPS backend
 import torch
 
+from utils import get_eye
+
 
 # =========================================================================================
 # Linear algebra stuff: solving linear systems and Steihaug-Toint Conjugate Gradient method
 # =========================================================================================
 
 
-def eye_like(A):    # Returns torch identity matrix with same dimensions, data type, and device as A
+def eye_like(A):    # Returns identity matrix with same dimensions, data type, and device as A
+    # For torch tensors, the matrix is cached and should not be modified in place
     assert(A.ndim == 2 and A.shape[0] == A.shape[1])
     if not isinstance(A, torch.Tensor): 
         return np.eye(A.shape[0])
     else:
-        return torch.eye(A.shape[0], dtype=A.dtype, device=A.device)
+        return get_eye(A.shape[0], A.dtype, A.device)
+
+
+def add_to_diagonal(A, eps, inplace=False):
+    # Returns A + eps*I, without allocating an identity matrix. A can also be a batch of matrices.
+    # If inplace is True, A is modified in place, which avoids allocating a new matrix 
+    # (only use this if A is a temporary that is not referenced elsewhere)
+    if not inplace:
+        A = A.clone() if isinstance(A, torch.Tensor) else A.copy()
+    if isinstance(A, torch.Tensor):
+        A.diagonal(dim1=-2, dim2=-1).add_(eps)
+    else:
+        A[np.diag_indices_from(A)] += eps
+    return A
 
 
 def solve_linear_psd(A, b, method=None):
@@ -36,9 +52,9 @@ def solve_linear_psd(A, b, method=None):
             else:
                 raise Exception("Method must be 'solve' or 'lstsq' if A is not a torch tensor")
 
-        except RuntimeError as e:
-            # If other methods fail (e.g., A is only PSD but not strictly positive definite),
-            # fall back to a more robust method
+        except (RuntimeError, np.linalg.LinAlgError) as e:
+            # If other methods fail (e.g., A is singular), fall back to a more robust method
+            # (np.linalg.solve raises LinAlgError, not RuntimeError, for singular matrices)
             print(f"Warning: numpy got error {str(e)} with method np.linalg.solve, using lstsq instead")
             do_lstsq = True
 
@@ -47,7 +63,11 @@ def solve_linear_psd(A, b, method=None):
 
     else:  # torch tensor
         if method is None:
-            method = 'solve_ex'
+            # Cholesky needs about half the flops of LU, and A is assumed PSD. If A turns out 
+            # not to be positive definite, the factorization fails and we fall back to LU 
+            # (solve_ex), and only then to lstsq, which is the slowest (it uses QR or SVD).
+            # cholesky_ex and solve_ex report failures without raising exceptions, and work for batches
+            method = 'cholesky_ex'
             
         do_lstsq = False  # Fallback
 
@@ -62,13 +82,20 @@ def solve_linear_psd(A, b, method=None):
                 L = torch.linalg.cholesky(A)
                 x = torch.cholesky_solve(b.unsqueeze(-1), L, upper=False)
                 
-                return  x.squeeze()
+                return  x.squeeze(-1)
 
             elif method == 'cholesky_ex':
-                L = torch.linalg.cholesky_ex(A)[0]
-                x = torch.cholesky_solve(b.unsqueeze(-1), L, upper=False)
-                
-                return  x.squeeze()
+                L, info = torch.linalg.cholesky_ex(A)
+                if not torch.any(info != 0):
+                    x = torch.cholesky_solve(b.unsqueeze(-1), L, upper=False)
+                    return  x.squeeze(-1)
+
+                # A (or some matrix in the batch) is not positive definite, but it may still be
+                # nonsingular, in which case LU is still much faster than lstsq
+                x, info = torch.linalg.solve_ex(A, b)
+                if torch.any(info != 0):  # A is singular
+                    print("Warning: torch cholesky_ex and solve_ex failed, matrix is singular, using lstsq instead")
+                    do_lstsq = True
 
             elif method == 'QR':
                 Q, R = torch.linalg.qr(A)
@@ -92,13 +119,34 @@ def solve_linear_psd(A, b, method=None):
             do_lstsq = True
 
         if do_lstsq:
-            x = torch.linalg.lstsq(A, b).solution
+            # b is treated as a (batch of) vector(s), as in the other methods
+            x = torch.linalg.lstsq(A, b.unsqueeze(-1)).solution.squeeze(-1)
 
     return x
 
 
 
 
+def solve_linear_lowrank(B, eps, b, u=None):
+    # Solve linear system (eps*I + BᵀB - u uᵀ) x = b, where B is a (k x n) torch tensor with k < n and 
+    # eps > 0, using the Woodbury identity 
+    #       (eps*I + BᵀB)⁻¹ = (I - Bᵀ (eps*I + B Bᵀ)⁻¹ B) / eps
+    # and the Sherman-Morrison formula for the rank-1 term -u uᵀ (if u is not None). 
+    # This costs O(k^2 n + k^3) rather than O(n^3), and never builds an n x n matrix. 
+    # Note that dividing by eps loses about log10(1/eps) digits of precision, e.g., in float32 with 
+    # eps=1e-4 the solution can have a relative error of about 1%
+    M = add_to_diagonal(B @ B.T, eps, inplace=True)       # k x k matrix
+
+    def solve_base(v):  # Returns (eps*I + BᵀB)⁻¹ v
+        return (v - B.T @ solve_linear_psd(M, B @ v)) / eps
+
+    x = solve_base(b)
+    if u is not None:
+        z = solve_base(u)
+        x = x + z * ((u @ x) / (1 - u @ z))
+    return x
+
+
 def benchmark_linsolve(num_runs=10, printx=False):
     # This function is used to benchmark the linear solvers
     # It creates a random symmetric positive definite matrix and a random vector
@@ -1,12 +1,12 @@
 # This file contains code to calculate observables and define data-based objectives
 
-import os, functools
+import os, functools, math
 import numpy as np
 
 os.environ["PYTORCH_ENABLE_MPS_FALLBACK"]='1'
 import torch
 
-from utils import numpy_to_torch
+from utils import numpy_to_torch, compile_if_enabled, get_triu_indices, get_offdiag_mask
 import optimizers
 
 def theta_cache(method):
@@ -62,6 +62,33 @@ def get_g_observables_bin(S_bin, F, i):
     # return S_i.contiguous()
 
 
+# The following functions are called at every iteration of the optimizers. They compute the tilting 
+# exponents θᵀg_k of all samples k with data._get_th_g, followed by a reduction over samples, so 
+# torch.compile (see USE_TORCH_COMPILE in config.py) can fuse the elementwise operations of 
+# _get_th_g (e.g., in CrossCorrelations1) with the reduction
+@compile_if_enabled
+def get_log_sum_tilts(data, theta):
+    # Return log Σ_k exp(θᵀg_k), computed with a single fused reduction
+    return torch.logsumexp(data._get_th_g(theta), dim=0)
+
+@compile_if_enabled
+def get_tilted_weights(data, theta):
+    # Return the normalized weights exp(θᵀg_k) / <exp(θᵀg)>, which have mean 1 over samples. 
+    # softmax is computed in log-space (it subtracts the maximum internally), so it cannot overflow,
+    # and the normalization constant is never formed explicitly or copied to the host
+    th_g = data._get_th_g(theta)
+    return torch.softmax(th_g, dim=0) * th_g.shape[0]
+
+
+@compile_if_enabled
+def get_weighted_hvp(samples, weights, mean, v):
+    # Product of v with the negative covariance of samples under weights (which sum to 1), where mean
+    # is the weighted mean. This pure tensor function is called at every CG iteration with the same
+    # shapes, so torch.compile (see USE_TORCH_COMPILE in config.py) can fuse the elementwise 
+    # operations around the two matrix-vector products
+    return mean * (mean @ v) - (weights * (samples @ v)) @ samples
+
+
 # The following classes are used to define the optimizers.Objective classes
 # based on samples of observables or state transitions. 
 
@@ -73,6 +100,12 @@ class DatasetBase(optimizers.Objective):
 
     def initialize_parameters(self, theta):  # This method is used to initialize the parameters variable
         return numpy_to_torch(theta, device=self.device)
+
+    @property
+    def max_objective(self):
+        # Upper bound on the objective, log(nsamples), which is reached when the tilted distribution
+        # concentrates on a single sample. Optimization is stopped if it is exceeded (overfitting)
+        return np.log(self.nsamples)
     
 
     # We should implement the following methods
@@ -82,9 +115,13 @@ class DatasetBase(optimizers.Objective):
     @functools.cached_property
     def rev_g_mean(self)     : raise NotImplementedError 
     def get_covariance(self) : raise NotImplementedError 
-    def _get_tilted_values(self, x)   : raise NotImplementedError
+    def _get_th_g(self, x)            : raise NotImplementedError  # tilting exponents θᵀg of reverse samples
     def get_tilted_mean(self, x)      :  raise NotImplementedError
     def get_titled_covariance(self, x): raise NotImplementedError
+
+    # @theta_cache
+    def _get_tilted_weights(self, theta):
+        return get_tilted_weights(self, numpy_to_torch(theta))
     
     def get_objective(self, theta): # Return objective value for parameters theta
         if self.nsamples == 0:
@@ -92,8 +129,8 @@ class DatasetBase(optimizers.Objective):
 
         theta = numpy_to_torch(theta)
 
-        th_g_max, norm_const, _ = self._get_tilted_values(theta)
-        log_Z                   = torch.log(norm_const) + th_g_max
+        # log of the normalization constant, log <exp(θᵀg)>
+        log_Z = get_log_sum_tilts(self, theta) - math.log(self.nsamples)
         return float( theta @ self.g_mean - log_Z )
     
     # This method is used to get the indices for training, validation, and test sets
@@ -130,7 +167,7 @@ class DatasetBase(optimizers.Objective):
         return self.g_mean - self.get_tilted_mean(theta)  # Gradient of the objective function
     
     def get_hessian(self, theta):
-        return -self.get_titled_covariance(theta)
+        return self.get_titled_covariance(theta).neg_()   # in place, the covariance is a new tensor
 
 
 def get_secondmoments(samples, num_chunks=None, weighting=None):
@@ -160,12 +197,12 @@ def get_secondmoments(samples, num_chunks=None, weighting=None):
             end = min((r + 1) * chunk_size, nsamples)
             g_chunk = samples[start:end]
             if weighting is None:
-                K += g_chunk.T @ g_chunk
+                K.addmm_(g_chunk.T, g_chunk)          # accumulate in place, without temporary matrices
             else:
                 weighted_chunk = weighting[start:end][:, None] * g_chunk
-                K += weighted_chunk.T @ g_chunk
+                K.addmm_(weighted_chunk.T, g_chunk)
 
-    return K / nsamples
+    return K.div_(nsamples)
     
 
 # This class implements an Objective using samples of observables. We use torch to speed things up.
@@ -227,13 +264,13 @@ class Dataset(DatasetBase):
     
         cov, rcov = None, None
         if return_forward or (self.rev_g_samples is None and return_reverse):
-            cov = get_secondmoments(self.g_samples, num_chunks=self.num_chunks) - torch.outer(self.g_mean, self.g_mean)
+            cov = get_secondmoments(self.g_samples, num_chunks=self.num_chunks).addr_(self.g_mean, self.g_mean, alpha=-1)
 
         if return_reverse:
             if self.rev_g_samples is None: 
                 rcov = cov   # antisymmetric observables, so they have the same covariance matrix
             else: 
-                rcov = get_secondmoments(self.rev_g_samples, num_chunks=self.num_chunks) - torch.outer(self.rev_g_mean, self.rev_g_mean)
+                rcov = get_secondmoments(self.rev_g_samples, num_chunks=self.num_chunks).addr_(self.rev_g_mean, self.rev_g_mean, alpha=-1)
 
         if   return_forward and not return_reverse : return cov
         elif return_reverse and not return_forward : return rcov
@@ -265,21 +302,11 @@ class Dataset(DatasetBase):
 
         return trn, val, tst
     
-    # @theta_cache
-    def _get_tilted_values(self, theta):  # We cache some slow calculations, e.g., of normalization constants and weight
-        theta = numpy_to_torch(theta)
+    def _get_th_g(self, theta):
         if self.rev_g_samples is not None:
-            th_g = self.rev_g_samples @ theta
+            return self.rev_g_samples @ theta
         else:
-            th_g = -(self.g_samples @ theta)
-        # To improve numerical stability, the exponentially tilting discounts exp(-th_g_max)
-        # The same multiplicative corrections enters into the normalization constant and the tilted
-        # means and covariance, so its cancels out
-        th_g_max    = torch.max(th_g)
-        exp_tilt    = torch.exp(th_g - th_g_max)
-        norm_const  = torch.mean(exp_tilt)
-
-        return th_g_max, norm_const, exp_tilt
+            return -(self.g_samples @ theta)
 
 
     # @theta_cache
@@ -288,9 +315,7 @@ class Dataset(DatasetBase):
             return theta * float('nan')
 
         theta = numpy_to_torch(theta)
-        _, norm_const, exp_tilt = self._get_tilted_values(theta)
-        # the first value (th_g_max) doesn't matter because it is cancelled by dividing by the norm_const
-        weights = exp_tilt / norm_const  
+        weights = self._get_tilted_weights(theta)
         if self.rev_g_samples is not None:
             return weights @ self.rev_g_samples / self.nsamples
         else:
@@ -302,14 +327,36 @@ class Dataset(DatasetBase):
             return torch.zeros((self.nobservables, self.nobservables), dtype=theta.dtype, device=theta.device) * float('nan')
 
         theta   = numpy_to_torch(theta)
-        _, norm_const, exp_tilt = self._get_tilted_values(theta)
-        mean    = self.get_tilted_mean(theta)
-        weights = exp_tilt / norm_const
+        # We compute the tilting weights once, and use them for both the tilted mean and second moments
+        # (rather than calling get_tilted_mean, which would recompute them)
+        weights = self._get_tilted_weights(theta)
+        if self.rev_g_samples is not None:
+            mean = weights @ self.rev_g_samples / self.nsamples
+            K    = get_secondmoments(self.rev_g_samples, num_chunks=self.num_chunks, weighting=weights)
+        else:
+            # Second moments of -g are the same as those of g, so we don't need to negate the samples
+            mean = -weights @ self.g_samples / self.nsamples
+            K    = get_secondmoments(self.g_samples, num_chunks=self.num_chunks, weighting=weights)
+        return K.addr_(mean, mean, alpha=-1)   # in-place rank-1 update, K is a new tensor
+
+
+    def get_hessian_operator(self, theta):
+        # Return function v -> H v, without materializing the Hessian H = -(tilted covariance).
+        # Each product costs O(nsamples x nobservables), rather than O(nobservables^2)
+        if self.nsamples == 0:
+            return lambda v: v * float('nan')
+
+        theta   = numpy_to_torch(theta)
+        weights = self._get_tilted_weights(theta) / self.nsamples
         if self.rev_g_samples is not None:
-            K = get_secondmoments(self.rev_g_samples, num_chunks=self.num_chunks, weighting=weights)
+            samples = self.rev_g_samples
+            mean    = weights @ samples
         else:
-            K = get_secondmoments(-self.g_samples, num_chunks=self.num_chunks, weighting=weights)
-        return K - torch.outer(mean, mean)
+            # Second moments of -g are the same as those of g, so we don't need to negate the samples
+            samples = self.g_samples
+            mean    = -weights @ samples
+
+        return functools.partial(get_weighted_hvp, samples, weights, mean)
 
 
     
@@ -347,33 +394,37 @@ class CrossCorrelations1(DatasetStateSamplesBase):
     # This class is used to calculate the antisymmetric observables g_{ij} = x_i * x'_j - x'_i * x_j
     # without materializing the full g_samples matrix. 
 
-    @functools.cached_property
-    def triu_indices(self):
-        return torch.triu_indices(self.N, self.N, offset=1, device=self.device)
+    @property
+    def triu_indices(self):  # cached across instances, e.g., train/validation/test splits
+        return get_triu_indices(self.N, self.device)
     
+    def _get_antisymmetric_theta(self, theta):
+        # Return NxN antisymmetric matrix Θ with Θ_ij = θ_ij and Θ_ji = -θ_ij for i<j. We write 
+        # both triangles directly, rather than building Θ_upper - Θ_upperᵀ with a temporary matrix.
+        # To avoid reallocating at every optimizer iteration, Θ is a persistent buffer: its diagonal 
+        # stays 0 and both triangles are overwritten in each call, so it doesn't need to be zeroed.
+        # Note that the returned matrix is only valid until the next call
+        triu  = self.triu_indices
+        Theta = getattr(self, '_theta_buffer', None)
+        if Theta is None or Theta.dtype != theta.dtype:
+            Theta = self._theta_buffer = torch.zeros((self.N, self.N), dtype=theta.dtype, device=self.device)
+        Theta[triu[0], triu[1]] = theta
+        Theta[triu[1], triu[0]] = -theta
+        return Theta
+
     @functools.cached_property
     def g_mean(self): # Calculate mean of observables under forward process
-        g_mean_raw = (self.X1.T @ self.X0 - self.X0.T @ self.X1 ) / self.nsamples  # shape (N, N)
+        # X1ᵀX0 is the transpose of X0ᵀX1, so we only need one matrix multiplication
+        C          = self.X0.T @ self.X1
+        g_mean_raw = (C.T - C) / self.nsamples  # shape (N, N)
         return g_mean_raw[self.triu_indices[0], self.triu_indices[1]]
 
 
-    # @theta_cache
-    def _get_tilted_values(self, theta):
-        theta = numpy_to_torch(theta)
-
-        triu = self.triu_indices
-
-        # θᵀg_k
-        Theta = torch.zeros((self.N, self.N), dtype=theta.dtype, device=self.device)
-        Theta[triu[0], triu[1]] = theta
-        Y = (Theta - Theta.T) @ self.X1.T
-        th_g = torch.sum(self.X0 * Y.T, dim=1)
-
-        th_g_max = torch.max(th_g)
-        exp_tilt = torch.exp(th_g - th_g_max)
-        norm_const  = torch.mean(exp_tilt)
-
-        return th_g_max, norm_const, exp_tilt
+    def _get_th_g(self, theta):
+        # θᵀg_k = x_0ᵀ Θ x_1, where Θ is the antisymmetric matrix of parameters. We compute 
+        # X1 Θᵀ (a view of Θ, no copy) so that the product has the same memory layout as X0
+        Theta = self._get_antisymmetric_theta(theta)
+        return torch.sum(self.X0 * (self.X1 @ Theta.T), dim=1)
     
     # @theta_cache
     def get_tilted_mean(self, theta):
@@ -382,8 +433,7 @@ class CrossCorrelations1(DatasetStateSamplesBase):
 
         triu = self.triu_indices
 
-        _, norm_const, exp_tilt = self._get_tilted_values(theta)
-        weights = exp_tilt / norm_const
+        weights = self._get_tilted_weights(theta)
         weighted_X = self.X0 * weights[:, None]
         mean_mat = (weighted_X.T @ self.X1) / self.nsamples  
         mean_mat_asymm = mean_mat - mean_mat.T
@@ -405,20 +455,11 @@ class CrossCorrelations2(CrossCorrelations1):
         # Here we consider g_{ij} = (x_i' - x_i) x_j
         return (self.diffX.T @ self.X0 / self.nsamples).flatten()
 
-    # @theta_cache
-    def _get_tilted_values(self, theta):
-        theta = numpy_to_torch(theta)
-
-        # 1. θᵀg_k 
+    def _get_th_g(self, theta):
+        # θᵀg_k 
         theta2d = torch.reshape(theta, (self.N, self.N))
         #theta2d.fill_diagonal_(0)  # Set diagonal to 0
-        th_g    = -torch.einsum('ij,ki,kj->k', theta2d, self.diffX, self.X1)
-
-        th_g_max = torch.max(th_g)
-        exp_tilt = torch.exp(th_g - th_g_max)
-        norm_const = torch.mean(exp_tilt)
-        
-        return th_g_max, norm_const, exp_tilt
+        return -torch.sum((self.diffX @ theta2d) * self.X1, dim=1)
     
 
     # @theta_cache
@@ -426,7 +467,115 @@ class CrossCorrelations2(CrossCorrelations1):
         if self.nsamples == 0:
             return theta * float('nan')
 
-        _, norm_const, exp_tilt = self._get_tilted_values(theta)
-        weights = exp_tilt / norm_const
-        tilted_g_mean = -torch.einsum('k,ki,kj->ij', weights, self.diffX, self.X1)  / self.nsamples
+        weights = self._get_tilted_weights(theta)
+        tilted_g_mean = -((self.diffX * weights[:, None]).T @ self.X1)  / self.nsamples
         return tilted_g_mean.flatten()
+
+
+
+class CrossCorrelationsMultipartite(DatasetBase):
+    # This class is used to estimate EP of all spins of a multipartite system jointly, using the 
+    # observables g_{ij} = (x'_i - x_i) x_j = -2 x_i x_j in the states where spin i flipped (as in 
+    # get_g_observables). The objective is the sum over spins of p_i times the objective of spin i, 
+    # where p_i is the frequency of spin i flips, so that its optimum is the total EP estimate. 
+    # The parameters θ_ij for j≠i (in row-major order) are stored in an NxN matrix Θ with zero 
+    # diagonal, so the tilts of all spins are computed with a single (T x N) @ (N x N) product.
+    #
+    # This is useful when a single objective for all parameters is needed, e.g., to use one 
+    # validation/early-stopping criterion for the whole system, and it works directly with S and F 
+    # without building the (nflips x N-1) observable samples of each spin. It is not faster than 
+    # optimizing the spins separately (every iteration processes all T samples for all spins, and the
+    # joint optimizer runs until the slowest spin converges), and since early stopping is joint, 
+    # estimates differ somewhat from those of separate per-spin optimization.
+    #
+    # The Hessian is not materialized (it has N^2 (N-1)^2 entries), but Hessian-vector products are
+    # available, e.g., for optimizers.NewtonMethodTrustRegion(matrix_free=True)
+    def __init__(self, S, F):
+        # Arguments:
+        # S          : 2d tensor (T x N) of states ∈ {-1,1}, as returned by spin_model.run_simulation
+        # F          : 2d tensor (T x N) of spin flips, as returned by spin_model.run_simulation
+        assert(S.shape == F.shape)
+        self.S = numpy_to_torch(S)
+        self.F = numpy_to_torch(F)
+        self.nsamples, self.N = self.S.shape
+        self.device       = self.S.device
+        self.nobservables = self.N * (self.N - 1)
+
+        self.nflips  = self.F.sum(axis=0)                      # number of flips of each spin
+        self.counts  = torch.clamp(self.nflips, min=1)
+        self.p       = self.nflips / max(self.N * self.nsamples, 1)  # frequency of spin i flips
+        self.offdiag = get_offdiag_mask(self.N, self.device)
+        # Mask of samples in which each spin did not flip (for spins that flipped at least once)
+        self.noflip  = (self.F == 0) & (self.nflips > 0)[None, :]
+
+    @functools.cached_property
+    def g_mean(self): # Weighted means p_i <g_ij>, which simplify to -2 Σ_k F_ki x_ki x_kj / (N T)
+        g_mean_raw = -2 * ((self.F * self.S).T @ self.S) / max(self.N * self.nsamples, 1)
+        return g_mean_raw[self.offdiag]
+
+    @functools.cached_property
+    def rev_g_mean(self): # Calculate mean of observables under reverse process
+        return -self.g_mean  # Antisymmetric observables
+
+    def _get_theta_matrix(self, theta):
+        Theta = torch.zeros((self.N, self.N), dtype=theta.dtype, device=self.device)
+        Theta[self.offdiag] = theta
+        return Theta
+
+    def _get_th_g(self, theta):
+        # Tilting exponents -θ_iᵀg = 2 x_i Σ_j θ_ij x_j for all samples (rows) and spins (columns),
+        # set to -inf in samples where the spin didn't flip
+        th_g = 2 * self.S * (self.S @ self._get_theta_matrix(theta).T)
+        return th_g.masked_fill(self.noflip, -torch.inf)
+
+    def get_objective(self, theta):
+        if self.nsamples == 0:
+            return float('nan')
+
+        theta = numpy_to_torch(theta)
+        log_Z = torch.logsumexp(self._get_th_g(theta), dim=0) - torch.log(self.counts)
+        return float( theta @ self.g_mean - self.p @ log_Z )
+
+    @property
+    def max_objective(self):
+        # The objective of spin i is bounded by log(nflips_i), so the joint objective is bounded 
+        # by Σ_i p_i log(nflips_i) (rather than by log(T))
+        return float(self.p @ torch.log(self.counts))
+
+    def _get_weights(self, theta):  # Tilted weights of samples, each column is normalized to 1
+        return torch.softmax(self._get_th_g(theta), dim=0)
+
+    def get_tilted_mean(self, theta):
+        if self.nsamples == 0:
+            return theta * float('nan')
+
+        theta   = numpy_to_torch(theta)
+        weights = self._get_weights(theta)
+        # Tilted means of reverse observables -g_ij = 2 x_i x_j, for all spins with one product
+        mean    = 2 * ((weights * self.S).T @ self.S)
+        return (self.p[:, None] * mean)[self.offdiag]
+
+    def get_hessian_operator(self, theta):
+        if self.nsamples == 0:
+            return lambda v: v * float('nan')
+
+        theta   = numpy_to_torch(theta)
+        weights = self._get_weights(theta)
+        WS      = weights * self.S
+        mean    = 2 * (WS.T @ self.S)
+
+        def hvp(v):
+            V  = self._get_theta_matrix(v)
+            gv = 2 * self.S * (self.S @ V.T)    # -vᵢᵀg for each sample and spin
+            K  = 2 * ((WS * gv).T @ self.S)    # tilted second moments applied to v, row i for spin i
+            Hv = -(K - mean * (mean * V).sum(axis=1, keepdims=True)) * self.p[:, None]
+            return Hv[self.offdiag]
+        return hvp
+
+    def split_train_val_test(self, **split_opts):
+        # Split current data set into training, validation, and testing part (by samples)
+        trn_indices, val_indices, tst_indices = self.get_trn_val_tst_indices(self.nsamples, **split_opts)
+        trn = type(self)(S=self.S[trn_indices], F=self.F[trn_indices])
+        val = type(self)(S=self.S[val_indices], F=self.F[val_indices])
+        tst = type(self)(S=self.S[tst_indices], F=self.F[tst_indices])
+        return trn, val, tst
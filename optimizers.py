@@ -13,6 +13,9 @@ def is_infnan(x): # return True if x is either infinite or NaN
 def l1norm(x):    # Used when printing debugging information
     return float(max(x.max(), -x.min())) if x is not None else 0
 
+def matvec(A, v): # Multiply A by vector v, where A is either a matrix or a function that computes A @ v
+    return A(v) if callable(A) else A @ v
+
 
 
 # This is the Objective class that should be implemented by the user, and it should 
@@ -27,6 +30,10 @@ class Objective(object):
         raise NotImplementedError 
     def get_hessian(self, x):  # Return hessian of the objective function for parameters x
         raise NotImplementedError 
+    def get_hessian_operator(self, x):  # Return function v -> H v, where H is the hessian at parameters x
+        # Objectives can override this to compute Hessian-vector products without materializing H
+        H = self.get_hessian(x)
+        return lambda v: H @ v
     
 
 
@@ -181,18 +188,23 @@ class NewtonMethod(Optimizer):
         super().__init__(**kwargs)
 
     def get_regularized_hessian(self, objective, x):
-        # Get the Hessian matrix and add a small regularization term
+        # Get the Hessian matrix and add a small regularization term. When maximizing, the 
+        # Hessian is negative semidefinite, so the regularization term is subtracted instead
         H = objective.get_hessian(x)
         if is_infnan(H.sum()):   # Error occured, usually it means x is too big
             if self.verbose: print(f'NewtonMethod : [Stopping] Invalid Hessian')
             return None 
-        return H + self.linsolve_eps * linear_solvers.eye_like(H)
+        eps = self.linsolve_eps if self.minimize else -self.linsolve_eps
+        return linear_solvers.add_to_diagonal(H, eps)
 
     def get_update(self, t, objective, x):
         grad = objective.get_gradient(x)
             
         H_reg = self.get_regularized_hessian(objective, x)
         if H_reg is None: return None
+
+        if not self.minimize:  # The Newton step is unchanged if we flip signs, this makes the system PSD
+            grad, H_reg = -grad, -H_reg
         
         return x - linear_solvers.solve_linear_psd(A=H_reg, b=grad) 
 
@@ -203,14 +215,36 @@ class NewtonMethodTrustRegion(NewtonMethod):
     default_max_iter=1000
     trust_radius=1                # maximum trust region
     steihaug_toint_cg_tol=1e-10   # tolerance for Steihaug-Toint CG method
-    def __init__(self, trust_radius=None, steihaug_toint_cg_tol=None, **kwargs):
+    matrix_free=False             # if True, CG uses Hessian-vector products instead of the Hessian matrix
+    def __init__(self, trust_radius=None, steihaug_toint_cg_tol=None, matrix_free=None, **kwargs):
         if trust_radius is not None:
             self.trust_radius = trust_radius
         if steihaug_toint_cg_tol is not None:
             self.steihaug_toint_cg_tol = steihaug_toint_cg_tol
+        if matrix_free is not None:
+            self.matrix_free = matrix_free
         super().__init__(**kwargs)
 
 
+    def get_trust_region_hessian(self, objective, x):
+        # Return regularized Hessian, with flipped sign when maximizing. If self.matrix_free, this 
+        # is a function that computes Hessian-vector products (see Objective.get_hessian_operator), 
+        # which is much cheaper than building and multiplying the full Hessian when there are many 
+        # observables. Otherwise it is the Hessian matrix 
+        if self.matrix_free:
+            hvp  = objective.get_hessian_operator(x)
+            if is_infnan(hvp(x*0 + 1).sum()):   # Error occured, as in get_regularized_hessian
+                if self.verbose: print('NewtonMethod : [Stopping] Invalid Hessian')
+                return None
+            sign = 1 if self.minimize else -1
+            return lambda v: sign * hvp(v) + self.linsolve_eps * v
+
+        H_reg = self.get_regularized_hessian(objective, x)
+        if H_reg is None or self.minimize: 
+            return H_reg
+        return -H_reg
+
+
     @staticmethod
     def steihaug_toint_cg(A, b, trust_radius, tol=1e-10, max_iter=None):
         """
@@ -219,7 +253,7 @@ class NewtonMethodTrustRegion(NewtonMethod):
         where A is symmetric (not necessarily positive definite).
         
         Args:
-            A : Symmetric matrix (n x n).
+            A : Symmetric matrix (n x n), or function that computes A @ v.
             b : Right-hand side vector (n).
             trust_radius (float): Trust region radius.
             tol (float): Tolerance for convergence on residual norm
@@ -250,7 +284,7 @@ class NewtonMethodTrustRegion(NewtonMethod):
             return x
 
         for _ in range(max_iter):
-            Hd = A @ d
+            Hd = matvec(A, d)
             dHd = d @ Hd
 
             if dHd <= 0: # Negative curvature detected → move to boundary
@@ -281,11 +315,11 @@ class NewtonMethodTrustRegion(NewtonMethod):
     def get_update(self, t, objective, x):
         grad = objective.get_gradient(x)
 
-        H_reg = self.get_regularized_hessian(objective, x)
+        H_reg = self.get_trust_region_hessian(objective, x)
         if H_reg is None: return None 
 
         if not self.minimize:
-            grad, H_reg = -grad, -H_reg
+            grad = -grad
 
         # Solve the constrained trust region problem using the
         # Steihaug-Toint Truncated Conjugate-Gradient Method
@@ -330,7 +364,7 @@ class TRON(NewtonMethodTrustRegion):
 
 
     def get_update(self, t, objective, x):
-        H_reg = self.get_regularized_hessian(objective, x)
+        H_reg = self.get_trust_region_hessian(objective, x)
         if H_reg is None: return None
 
         if self.adjusted_trust_radius <= self.trust_radius_min:
@@ -338,7 +372,7 @@ class TRON(NewtonMethodTrustRegion):
 
         grad = objective.get_gradient(x)
         if not self.minimize:
-            grad, H_reg = -grad, -H_reg
+            grad = -grad
 
         if not hasattr(self, 'f_last_trn') or self.f_last_trn is None:
             self.f_last_trn = objective.get_objective(x)
@@ -352,7 +386,7 @@ class TRON(NewtonMethodTrustRegion):
             new_x      = x - delta_x
             f_new_trn  = objective.get_objective(new_x)
 
-            pred_improvement = (grad @ delta_x + 0.5 * delta_x @ (H_reg @ delta_x))
+            pred_improvement = (grad @ delta_x + 0.5 * delta_x @ matvec(H_reg, delta_x))
             improvement      = f_new_trn - self.f_last_trn
             if self.minimize: 
                 improvement  = -improvement
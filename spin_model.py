@@ -213,27 +213,31 @@ def convert_to_nonmultipartite(S, F):
 
 # ***** Entropy production estimates from empirical statistics *****
 
-import observables
 import utils
 def get_empirical_EP(beta, J, S, F):
     # Calculate empirical EP from samples S and F
     num_samples_per_spin, N = S.shape
     total_flips = N * num_samples_per_spin  # Total spin-flip attempts
 
-    # Running sums to keep track of EP estimates
-    sigma_emp = 0.0
-
-    # Because system is multipartite, we can separately estimate EP for each spin
-
-    frequencies = F.sum(axis=0)/total_flips      # frequency of spin i flips
-    for i in range(N):
-        # Select states in which spin i flipped and use it create object for EP estimation 
-        g_samples  = observables.get_g_observables(S, F, i)
-        if len(g_samples) > 0:
-            g_mean     = g_samples.mean(axis=0)
-            sigma_emp += frequencies[i] * get_spin_empirical_EP(beta, J, i, g_mean)
-
-    return sigma_emp
+    # Because system is multipartite, EP is the sum of contributions of each spin, weighted by the 
+    # frequency of spin i flips. These are computed for all spins at once by get_all_spins_empirical_EP
+    frequencies = utils.numpy_to_torch(F).sum(axis=0)/total_flips
+    return float(frequencies @ get_all_spins_empirical_EP(beta, J, S, F))
+
+
+def get_all_spins_empirical_EP(beta, J, S, F):
+    # Calculate ``ground truth'' EP contributions from all spins, returning a 1d tensor (N) whose
+    # i-th entry equals get_spin_empirical_EP(beta, J, i, g_mean) for the observables of spin i 
+    # (or 0 if spin i never flipped). Rather than looping over spins, the sums over samples of 
+    # g_ij = -2 x_i x_j in the states where spin i flipped are computed with a single matrix product, 
+    # and contracted with the couplings J_ij (j≠i) with one elementwise product and reduction
+    S      = utils.numpy_to_torch(S)
+    F      = utils.numpy_to_torch(F)
+    J      = utils.numpy_to_torch(J)
+    g_sums = -2 * ((F * S).T @ S)             # row i contains sums of g_ij over flips of spin i
+    g_sums.fill_diagonal_(0)                  # g_ii is not an observable, due to our convention
+    counts = F.sum(axis=0).clamp(min=1)       # avoid division by 0 for spins that never flipped
+    return float(beta) * (J * g_sums).sum(axis=1) / counts
 
 
 def get_spin_empirical_EP(beta, J, i, g_mean):
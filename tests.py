@@ -12,6 +12,8 @@ utils.set_default_torch_device()
 import spin_model
 import ep_estimators
 import observables
+import linear_solvers
+import torch
 
 OPTIMIZE_VERBOSE=2
 
@@ -45,6 +47,12 @@ def test_EP():
     beta, J, S, F = get_simulation_results()
     spin_model.get_empirical_EP(beta, J, S, F)
 
+    # Compare contributions of all spins to the per-spin calculation
+    spins_emp = utils.torch_to_numpy(spin_model.get_all_spins_empirical_EP(beta, J, S, F))
+    for i in range(J.shape[0]):
+        g_mean = observables.get_g_observables(S, F, i).mean(axis=0)
+        assert(abs(spins_emp[i] - spin_model.get_spin_empirical_EP(beta, J, i, g_mean)) < 1e-4)
+
 def test_NewtonVsDefault():
     beta, J, S, F = get_simulation_results()
     g_samples     = observables.get_g_observables(S, F, 0)
@@ -54,6 +62,61 @@ def test_NewtonVsDefault():
     assert(v0 > 1.8)
     assert(abs(v0-v1) < 1e-1)
 
+def test_Newton1Step_multipartite():
+    beta, J, S, F = get_simulation_results()
+    sigmas, thetas = ep_estimators.get_EP_Newton1Step_multipartite(S, F)
+    sigmas2, thetas2 = ep_estimators.get_EP_Newton1Step_multipartite(S, F, num_chunks=10)
+    assert(np.allclose(sigmas, sigmas2, atol=1e-5))
+    for dtype in ['float64', 'float16', 'bfloat16']:  # products over samples are exact in each chunk
+        sigmas3, _ = ep_estimators.get_EP_Newton1Step_multipartite(S, F, dtype=dtype)
+        assert(np.allclose(sigmas, sigmas3, atol=1e-5))
+    sigmas4, thetas4 = ep_estimators.get_EP_Newton1Step_multipartite(S, F, use_numba=True)
+    assert(np.allclose(sigmas, sigmas4, atol=1e-4))
+    assert(np.allclose(thetas, thetas4, atol=1e-3))
+    for i in range(S.shape[1]):
+        data     = observables.Dataset(g_samples=observables.get_g_observables(S, F, i))
+        _, theta = ep_estimators.get_EP_Newton1Step(data)
+        assert(np.allclose(thetas[i], theta, atol=1e-3))
+        assert(abs(sigmas[i] - data.get_objective(theta)) < 1e-3)
+
+def test_Newton1Step_multipartite_numba_failure():
+    # If spins 0 and 1 are always equal, g_01 = -2 x_0 x_1 is constant when spin 0 flips (and g_10 when
+    # spin 1 flips), so without regularization their covariances are singular and Cholesky fails
+    beta, J, S, F = get_simulation_results()
+    S2 = S.copy()
+    S2[:, 1] = S2[:, 0]
+    sigmas, thetas = ep_estimators.get_EP_Newton1Step_multipartite(S2, F, linsolve_eps=0, use_numba=True)
+    assert(np.isnan(sigmas[0]) and np.isnan(sigmas[1]))
+    assert(np.all(np.isnan(thetas[:2])))
+
+def test_multipartite_objective():
+    beta, J, S, F = get_simulation_results()
+    N      = S.shape[1]
+    p      = F.sum(axis=0) / F.size
+    data   = observables.CrossCorrelationsMultipartite(S, F)
+    sigmas, thetas = ep_estimators.get_EP_Newton1Step_multipartite(S, F)
+    assert(abs(data.get_objective(thetas.flatten()) - p @ sigmas) < 1e-4)
+
+    theta = np.random.rand(N, N-1) / N
+    grad  = utils.torch_to_numpy(data.get_gradient(theta.flatten())).reshape(N, N-1)
+    v     = utils.numpy_to_torch(np.random.randn(N, N-1))
+    hvp   = utils.torch_to_numpy(data.get_hessian_operator(theta.flatten())(v.flatten())).reshape(N, N-1)
+    for i in range(N):
+        data_i = observables.Dataset(g_samples=observables.get_g_observables(S, F, i))
+        grad_i = utils.torch_to_numpy(data_i.get_gradient(theta[i]))
+        hvp_i  = utils.torch_to_numpy(data_i.get_hessian(theta[i]) @ v[i])
+        assert(np.allclose(grad[i], p[i] * grad_i, atol=1e-5))
+        assert(np.allclose(hvp[i], p[i] * hvp_i, atol=1e-5))
+
+    trn, val, tst = data.split_train_val_test()
+    ep_estimators.get_EP_Estimate(trn, validation=val, test=tst)
+
+    # Without holdout, the joint estimate is bounded by Σ_i p_i log(nflips_i), as for separate spins
+    counts = np.maximum(F.sum(axis=0), 1)
+    assert(abs(data.max_objective - p @ np.log(counts)) < 1e-4)
+    v, _ = ep_estimators.get_EP_Estimate(data)
+    assert(v <= data.max_objective + 1e-4)
+
 def test_numpy_to_torch():
     x = np.random.randn(100, 10)
     utils.numpy_to_torch(x)
@@ -246,6 +309,61 @@ def test_optimizer_base(split=0, max_trn_objective=None, max_val_objective=None,
                 minimize=False, max_trn_objective=max_trn_objective, max_val_objective=max_val_objective)
     
                                     
+def test_hessian_operator():
+    beta, J, S, F = get_simulation_results()
+    trn   = observables.Dataset(observables.get_g_observables(S, F, 9))
+    theta = utils.numpy_to_torch(np.random.rand(trn.nobservables))
+    v     = utils.numpy_to_torch(np.random.randn(trn.nobservables))
+    assert((trn.get_hessian_operator(theta)(v) - trn.get_hessian(theta) @ v).norm() < 1e-4)
+
+    v0, _ = ep_estimators.get_EP_Estimate(trn, optimizer=optimizers.TRON(trust_radius=1/4))
+    v1, _ = ep_estimators.get_EP_Estimate(trn, optimizer=optimizers.TRON(trust_radius=1/4, matrix_free=True))
+    assert(abs(v0-v1) < 1e-3)
+
+
+def test_MTUR_lowrank():
+    # With fewer samples than observables, get_EP_MTUR uses the Woodbury identity; compare to dense solve
+    beta, J, S, F = get_simulation_results()
+    g_samples = observables.get_g_observables(S, F, 9)[:4]    # 9 observables, 4 (+4 reverse) samples
+    for do_rev in [True, False]:
+        data = observables.Dataset(g_samples, rev_g_samples=-g_samples if do_rev else None)
+        assert(data.forward_nsamples + (data.nsamples if do_rev else 0) < data.nobservables)
+        v, x = ep_estimators.get_EP_MTUR(data, linsolve_eps=1e-4)
+
+        # Reference in float64, since dividing by eps=1e-4 loses precision in float32 (for both methods)
+        cov, mean_diff = get_mixture_covariance_float64(data)
+        x2   = np.linalg.solve(cov + 1e-4*np.eye(len(cov)), mean_diff)
+        assert(abs(v - x2 @ mean_diff / 2) < 1e-2 * abs(v))
+        assert(np.abs(x - x2).max() < 5e-2 * np.abs(x2).max())
+
+    # Direct comparison of solve_linear_lowrank, including the Sherman-Morrison term
+    B = utils.numpy_to_torch(np.random.randn(5, 20))
+    u = utils.numpy_to_torch(np.random.randn(20)) / 10
+    b = utils.numpy_to_torch(np.random.randn(20))
+    for uu in [None, u]:
+        A = linear_solvers.add_to_diagonal(B.T @ B - (torch.outer(uu, uu) if uu is not None else 0), 1.0)
+        x  = linear_solvers.solve_linear_lowrank(B, 1.0, b, u=uu)
+        x2 = linear_solvers.solve_linear_psd(A, b)
+        assert((x - x2).norm() < 1e-4 * x2.norm())
+
+
+def test_linsolve_fallback():
+    # Nonsingular but indefinite matrix (Cholesky fails, LU works), and singular numpy matrix (lstsq)
+    A = utils.numpy_to_torch(np.diag([2.0, -1.0, 3.0]))
+    b = utils.numpy_to_torch(np.array([2.0, 1.0, 3.0]))
+    assert(np.allclose(utils.torch_to_numpy(linear_solvers.solve_linear_psd(A, b)), [1, -1, 1]))
+    x = linear_solvers.solve_linear_psd(np.diag([1.0, 0.0]), np.array([1.0, 0.0]))
+    assert(np.allclose(x, [1, 0]))
+
+
+def get_mixture_covariance_float64(data):  # Covariance of mixture (p + ~p)/2, and <g>_p - <g>_~p
+    g_samples     = utils.torch_to_numpy(data.g_samples).astype(np.float64)
+    rev_g_samples = -g_samples if data.rev_g_samples is None else utils.torch_to_numpy(data.rev_g_samples).astype(np.float64)
+    samples = np.vstack([g_samples, rev_g_samples])
+    mean    = samples.mean(axis=0)
+    return samples.T @ samples / samples.shape[0] - np.outer(mean, mean), g_samples.mean(axis=0) - rev_g_samples.mean(axis=0)
+
+                                    
 def test_optimizer_bounds():
     test_optimizer_base(split=False, max_trn_objective=1e2, max_iter=100)
     test_optimizer_base(split=True, max_trn_objective=1e2, max_val_objective=1e2, max_iter=100)
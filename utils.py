@@ -1,12 +1,12 @@
 # Includes various handy functions
-import os
+import os, functools
 import numpy as np
 import warnings
 
 os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"  # Enable fallback for MPS backend
 import torch
 
-from config import DTYPE, USE_GPU   # Default data type for torch tensors
+from config import DTYPE, USE_GPU, USE_TORCH_COMPILE   # Default data type for torch tensors
 
 # Helpful tensor processing functions
 
@@ -44,6 +44,21 @@ def outer_product(a,b):
     # Outer product of two vectors a and b
     return torch.outer(a,b)
 
+
+# The following return cached constant tensors, so that repeated calls (e.g., once per spin, or for 
+# every train/validation/test split) don't allocate new tensors. Do not modify the results in place
+@functools.lru_cache(maxsize=None)
+def get_eye(n, dtype, device):  # n x n identity matrix
+    return torch.eye(n, dtype=dtype, device=device)
+
+@functools.lru_cache(maxsize=None)
+def get_offdiag_mask(n, device):  # n x n bool matrix that is True off the diagonal
+    return ~get_eye(n, torch.bool, device)
+
+@functools.lru_cache(maxsize=None)
+def get_triu_indices(n, device):  # indices of upper triangle (without diagonal) of n x n matrix
+    return torch.triu_indices(n, n, offset=1, device=device)
+
 # Torch stuff
 
 def set_default_torch_device():
@@ -67,6 +82,16 @@ def set_default_torch_device():
     return device
 
 
+def compile_if_enabled(fn):
+    # Decorator that compiles a tensor function with torch.compile if USE_TORCH_COMPILE is set
+    # in config.py. Compilation happens on the first call. If the function is later called with 
+    # different shapes (e.g., train/validation/test splits), it is recompiled once with dynamic 
+    # shapes, which are then reused for all sizes
+    if not USE_TORCH_COMPILE:
+        return fn
+    return torch.compile(fn)
+
+
 def empty_torch_cache():  # Empty torch cache
     if torch.cuda.is_available() and torch.cuda.current_device() >= 0:
         torch.cuda.empty_cache()